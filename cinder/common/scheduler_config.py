@@ -156,7 +156,8 @@ Related options:
             default=60,
             help="""
 This value controls how long a successful attestation is cached. Once this
-period has elapsed, a new attestation request will be made. See the
+period has elapsed, a new attestation request will be made. Hosts reported
+as untrusted or unknown are cached for a quarter of this period. See the
 `attestation_server` help text for more information about host verification.
 
 This option is only used by the FilterScheduler and its subclasses; if you use
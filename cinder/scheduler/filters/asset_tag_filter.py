@@ -47,16 +47,19 @@ the Open Attestation project at:
 #ge0rgi: Initialized trust_verify
 #ge0rgi: Added is_trusted
 
-import urllib2
-import httplib
-import socket
-import backports.ssl as ssl
-import json
 import ast
+import json
+import threading
+import time
 
+from eventlet import greenpool
 from oslo_config import cfg
-
 from oslo_log import log as logging
+import requests
+from requests import adapters
+from six.moves.urllib import parse as urlparse
+
+from cinder.i18n import _LE
 from cinder.scheduler import filters
 from lxml import etree
 import base64
@@ -66,38 +69,31 @@ LOG = logging.getLogger(__name__)
 
 CONF = cfg.CONF
 
+SAML_ASSERTION_FORMAT = "application/samlassertion+xml"
 
-class HTTPSClientAuthConnection(httplib.HTTPSConnection):
-    """
-    Class to make a HTTPS connection, with support for full client-based
-    SSL Authentication
-    """
-
-    def __init__(self, host, port, key_file, cert_file, ca_file, timeout=None):
-        httplib.HTTPSConnection.__init__(self, host,
-                                         key_file=key_file,
-                                         cert_file=cert_file)
-        self.host = host
-        self.port = port
-        self.key_file = key_file
-        self.cert_file = cert_file
-        self.ca_file = ca_file
-        self.timeout = timeout
-
-    def connect(self):
-        """
-        Connect to a host on a given (SSL) port.
-        If ca_file is pointing somewhere, use it to check Server Certificate.
+# Host attestations cached per host name as
+# {hostname: _AttestationCacheEntry}, shared by all filter instances.
+_attestation_cache = {}
+_attestation_cache_lock = threading.Lock()
 
-        Redefined/copied and extended from httplib.py:1105 (Python 2.6.x).
-        This is needed to pass cert_reqs=ssl.CERT_REQUIRED as parameter to
-        ssl.wrap_socket(), which forces SSL to check server certificate
-        against our client certificate.
-        """
-        sock = socket.create_connection((self.host, self.port), self.timeout)
-        self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file,
-                                    ca_certs=self.ca_file)
-        # cert_reqs=ssl.CERT_REQUIRED)
+# SAML assertion parser and XPath expressions, compiled once
+_SAML_NS = {'saml2p': 'urn:oasis:names:tc:SAML:2.0:protocol',
+            'saml2': 'urn:oasis:names:tc:SAML:2.0:assertion'}
+_SAML_PARSER = etree.XMLParser(resolve_entities=False, huge_tree=False)
+_XP_ATTRIBUTES = etree.XPath('saml2:AttributeStatement/saml2:Attribute',
+                             namespaces=_SAML_NS)
+_XP_ATTRIBUTE_VALUE = etree.XPath('saml2:AttributeValue/text()',
+                                  namespaces=_SAML_NS)
+
+
+class _AttestationCacheEntry(object):
+    # Cached attestation of a host, valid until expiry
+    __slots__ = ('expiry', 'trust', 'asset_tag')
+
+    def __init__(self, expiry, trust, asset_tag):
+        self.expiry = expiry
+        self.trust = trust
+        self.asset_tag = asset_tag
 
 
 class AttestationService(object):
@@ -111,48 +107,68 @@ class AttestationService(object):
         self.key_file = None
         self.cert_file = None
         self.ca_file = CONF.trusted_computing.attestation_server_ca_file
+        # False skips the server certificate check, otherwise the CA file
+        # to check it against or True for the system CAs
+        if CONF.trusted_computing.attestation_insecure_ssl:
+            self.verify = False
+        elif self.ca_file:
+            self.verify = self.ca_file
+        else:
+            self.verify = True
         self.request_count = 100
+        # Requests are issued relative to the attestation API url
+        self._url_prefix = "https://%s:%d%s" % (self.host, self.port,
+                                                self.api_url)
+        self.max_workers = 16
+        # The request headers only depend on the auth blob
+        self._headers = {}
+        if self.auth_blob:
+            auth = base64.b64encode(
+                self.auth_blob.encode('utf-8')).decode('utf-8')
+            self._headers['x-auth-blob'] = self.auth_blob
+            self._headers['Authorization'] = "Basic " + auth
+            self._headers['Accept'] = SAML_ASSERTION_FORMAT
+            # self._headers['Content-Type'] = 'application/json'
+        # Keep-alive connections to the attestation server are pooled
+        # and reused across requests
+        self._session = requests.Session()
+        self._session.mount('https://', adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=32))
+        if self.cert_file:
+            self._session.cert = (self.cert_file, self.key_file)
+        self._session.verify = self.verify
 
     def _do_request(self, method, action_url, params, headers):
         # Connects to the server and issues a request.
         # :returns: result data
         # :raises: IOError if the request fails
 
-        # action_url = "%s" % (self.api_url)
+        action_url = self._url_prefix + action_url
         try:
-            c = HTTPSClientAuthConnection(self.host, self.port,
-                                          key_file=self.key_file,
-                                          cert_file=self.cert_file,
-                                          ca_file=self.ca_file)
-
-            c.request(method, action_url, json.dumps(params), headers)
-            res = c.getresponse()
-            status_code = res.status
-            data = res.read()
-            c.close()
-            if status_code in (httplib.OK,
-                               httplib.CREATED,
-                               httplib.ACCEPTED,
-                               httplib.NO_CONTENT):
-                return httplib.OK, data
-            return status_code, None
-
-        except (socket.error, IOError):
+            res = self._session.request(method, action_url,
+                                        data=json.dumps(params),
+                                        headers=headers)
+        except requests.exceptions.RequestException:
             return IOError, None
 
-    def _request(self, cmd, subcmd, host_uuid, resp_format="application/samlassertion+xml"):
+        status_code = res.status_code
+        if status_code in (requests.codes.OK,
+                           requests.codes.CREATED,
+                           requests.codes.ACCEPTED,
+                           requests.codes.NO_CONTENT):
+            return requests.codes.OK, res.content
+        return status_code, None
+
+    def _request(self, cmd, subcmd, host_uuid,
+                 resp_format=SAML_ASSERTION_FORMAT):
         # Setup the header & body for the request
 
-        headers = {}
-        auth = base64.encodestring(self.auth_blob).replace('\n', '')
-        if self.auth_blob:
-            headers['x-auth-blob'] = self.auth_blob
-            headers['Authorization'] = "Basic " + auth
-            headers['Accept'] = resp_format
-            # headers['Content-Type'] = 'application/json'
+        headers = self._headers
+        if self.auth_blob and resp_format != SAML_ASSERTION_FORMAT:
+            headers = dict(headers, Accept=resp_format)
         # status, res = self._do_request(cmd, subcmd, params, headers)
         status, data = self._do_request(cmd, subcmd, host_uuid, headers)
-        if status != httplib.OK:
+        if status != requests.codes.OK:
             return status, None
         return status, data
 
@@ -167,131 +183,269 @@ class AttestationService(object):
 
         # status, data = self._request("POST", "PollHosts", hosts)
         # status, data = self._request("POST", "", host_uuid)
-        action_url = "%s?nameEqualTo=%s" % (self.api_url, hostname)
+        action_url = "?" + urlparse.urlencode({'nameEqualTo': hostname})
         status, data = self._request("GET", action_url, hostname)
 
         return data
 
+    def do_attestation_bulk(self, hostnames):
+        """Attests a list of compute nodes through OAT service.
+
+        :param hostnames: host names to be attested
+        :returns: dictionary mapping each host name to its attestation report
+        """
+        # The OAT service is queried per host, run the queries concurrently
+        hostnames = list(hostnames)
+        pool = greenpool.GreenPool(self.max_workers)
+        return dict(zip(hostnames, pool.imap(self.do_attestation, hostnames)))
+
+
+_ATTESTATION_SERVICE = None
+
+
+def _get_attestation_service():
+    # The scheduler builds a filter instance per request, share one service
+    # and its idle connections across all of them
+    global _ATTESTATION_SERVICE
+    if _ATTESTATION_SERVICE is None:
+        _ATTESTATION_SERVICE = AttestationService()
+    return _ATTESTATION_SERVICE
+
 
 class TrustAssertionFilter(filters.BaseBackendFilter):
 
-    def backend_passes(self, backend_state, filter_properties):
-        """Only return hosts with required Trust level."""
+    @property
+    def attestservice(self):
+        # Built on first use, requests without trust never need it
+        return _get_attestation_service()
+
+    def _get_trust_requirements(self, filter_properties):
+        """Returns the trust verification required by a scheduling request.
+
+        :returns: tuple of the trust and asset tag verification flags and
+                  the parsed asset tag selections
+        """
         verify_asset_tag = False
-        verify_trust_status = False
+        sel_tags = None
 
-        request_spec = filter_properties['request_spec']
         metadata = filter_properties["metadata"]
-        is_blank_volume = request_spec['image_id'] is None and request_spec['snapshot_id'] is None
-        if metadata == {} and is_blank_volume and CONF.trusted_computing.create_blank_on_trusted:
-            metadata['trust']='trusted'
-            metadata['asset_tags']= CONF.trusted_computing.default_asset_tags
-
-        trust_verify = ''
-        if ('trust' in metadata):
-            trust_verify = 'true'
-
-        LOG.debug(" Verify trust: %s" % trust_verify)
-
-        # if tag_selections is None or tag_selections == 'Trust':
-        if trust_verify == 'true':
-            # Get the Tag verification flag from the image properties
-            if 'asset_tags' in metadata:
-                tag_selections = metadata['asset_tags']  # comma seperated values
+        if 'trust' not in metadata:
+            # Only blank volumes without metadata may still require trust
+            if (metadata != {} or
+                    not CONF.trusted_computing.create_blank_on_trusted):
+                return False, False, None
+            request_spec = filter_properties['request_spec']
+            is_blank_volume = (request_spec['image_id'] is None and
+                               request_spec['snapshot_id'] is None)
+            if not is_blank_volume:
+                return False, False, None
+            metadata['trust'] = 'trusted'
+            metadata['asset_tags'] = CONF.trusted_computing.default_asset_tags
+
+        # Get the Tag verification flag from the image properties
+        if 'asset_tags' in metadata:
+            tag_selections = metadata['asset_tags']  # comma seperated values
+        else:
+            tag_selections = 'None'
+        LOG.debug(tag_selections)
+        if (tag_selections is not None and tag_selections != {} and
+                tag_selections != 'None'):
+            verify_asset_tag = True
+            sel_tags = self._parse_tag_selections(tag_selections)
+
+        return True, verify_asset_tag, sel_tags
+
+    def _parse_tag_selections(self, tag_selections):
+        # Parses the asset tag selections once per request,
+        # returns None if they are not a valid dictionary
+        try:
+            selections = tag_selections.lower()
+        except AttributeError:
+            LOG.debug("Invalid asset tag selections %s", tag_selections)
+            return None
+        try:
+            sel_tags = json.loads(selections.replace("'", '"'))
+        except ValueError:
+            # Fall back for Python literals that are not valid JSON, such as
+            # tuples, quoted apostrophes or trailing commas
+            try:
+                sel_tags = ast.literal_eval(selections)
+            except (SyntaxError, TypeError, ValueError):
+                LOG.debug("Invalid asset tag selections %s", tag_selections)
+                return None
+        if not isinstance(sel_tags, dict):
+            return None
+        # Allowed values as sets, a single value selects only itself
+        try:
+            return {tag: (frozenset(allowed)
+                          if isinstance(allowed, (list, tuple, set, frozenset))
+                          else frozenset([allowed]))
+                    for tag, allowed in sel_tags.items()}
+        except TypeError:
+            LOG.debug("Invalid asset tag selections %s", tag_selections)
+            return None
+
+    def _get_cached_attestation(self, hostname):
+        # Returns the cached (trust, asset_tag) of a host, None if expired
+        with _attestation_cache_lock:
+            entry = _attestation_cache.get(hostname)
+        if entry is None or time.time() >= entry.expiry:
+            return None
+        return entry.trust, entry.asset_tag
+
+    def _cache_attestation(self, hostname, trust, asset_tag):
+        # Successful attestations are cached for attestation_auth_timeout,
+        # untrusted and unknown hosts for a quarter of it so that they are
+        # picked up soon once they become trusted
+        ttl = CONF.trusted_computing.attestation_auth_timeout
+        if not trust:
+            ttl /= 4.0
+        expiry = time.time() + ttl
+        with _attestation_cache_lock:
+            _attestation_cache[hostname] = _AttestationCacheEntry(
+                expiry, trust, asset_tag)
+
+    def _drop_attestation(self, hostname):
+        # Forgets the cached attestation of a host
+        with _attestation_cache_lock:
+            _attestation_cache.pop(hostname, None)
+
+    def _attest_hosts(self, hostnames):
+        """Attests hosts, reusing the cached attestations still valid.
+
+        :param hostnames: host names to be attested
+        :returns: dictionary mapping each host name to its trust and asset tags
+        """
+        results = {}
+        stale_hosts = []
+        for hostname in hostnames:
+            cached = self._get_cached_attestation(hostname)
+            if cached is None:
+                stale_hosts.append(hostname)
             else:
-                tag_selections = 'None'
-            LOG.debug(tag_selections)
-            verify_trust_status = True
-            if tag_selections != None and tag_selections != {} and tag_selections != 'None':
-                verify_asset_tag = True
-
-        if not verify_trust_status:
-            # Filter returns success/true if neither trust or tag has to be verified.
-            return True
-
-        self.attestservice = AttestationService()
-        hostname = backend_state.host.split("@")[0]
-        LOG.debug("Getting the attestation report")
-        host_data = self.attestservice.do_attestation(hostname)
-        trust, asset_tag = self.verify_and_parse_saml(host_data)
+                results[hostname] = cached
+
+        if stale_hosts:
+            LOG.debug("Getting the attestation reports")
+            hosts_data = self.attestservice.do_attestation_bulk(stale_hosts)
+            for hostname in stale_hosts:
+                host_data = hosts_data.get(hostname)
+                trust, asset_tag = self.verify_and_parse_saml(host_data)
+                if host_data is not None:
+                    self._cache_attestation(hostname, trust, asset_tag)
+                else:
+                    # No report, retry the host on the next request
+                    self._drop_attestation(hostname)
+                results[hostname] = (trust, asset_tag)
+        return results
+
+    def _verify_host(self, trust, asset_tag, verify_asset_tag, sel_tags):
+        # Checks the attestation of a host against the request
         if not trust:
             return False
 
         if verify_asset_tag:
             # Verify the asset tag restriction
-            LOG.debug('Asset tag %s' % asset_tag)
-            LOG.debug('Tag selection %s'% tag_selections)
-            return self.verify_asset_tag(asset_tag, tag_selections)
+            LOG.debug('Asset tag %s', asset_tag)
+            LOG.debug('Tag selection %s', sel_tags)
+            return self.verify_asset_tag(asset_tag, sel_tags)
 
         return True
 
+    def filter_all(self, filter_obj_list, filter_properties):
+        """Yield the backends with the required Trust level.
+
+        The trust requirements are evaluated and all candidate backends
+        are attested once per scheduling request rather than per backend.
+        """
+        verify_trust_status, verify_asset_tag, sel_tags = (
+            self._get_trust_requirements(filter_properties))
+        if not verify_trust_status:
+            # Neither trust nor asset tags have to be verified
+            for obj in filter_obj_list:
+                yield obj
+            return
+
+        backends = list(filter_obj_list)
+        hostnames = [backend.host.split("@")[0] for backend in backends]
+        # Backends sharing a physical host are attested only once
+        attestations = self._attest_hosts(set(hostnames))
+        for backend, hostname in zip(backends, hostnames):
+            trust, asset_tag = attestations[hostname]
+            if self._verify_host(trust, asset_tag, verify_asset_tag,
+                                 sel_tags):
+                yield backend
+
+    def backend_passes(self, backend_state, filter_properties):
+        """Only return hosts with required Trust level."""
+        verify_trust_status, verify_asset_tag, sel_tags = (
+            self._get_trust_requirements(filter_properties))
+        if not verify_trust_status:
+            # Neither trust nor asset tags have to be verified
+            return True
+
+        hostname = backend_state.host.split("@")[0]
+        trust, asset_tag = self._attest_hosts([hostname])[hostname]
+        return self._verify_host(trust, asset_tag, verify_asset_tag, sel_tags)
+
     def verify_and_parse_saml(self, saml_data):
         trust = False
         asset_tag = {}
 
+        if not saml_data:
+            return trust, asset_tag
+
         # Trust attestation service responds with a JSON in case the given host name is not found
         # Need to update this after the mt. wilson service is updated to return consistent message formats
-        try:
-            if json.loads(saml_data):
-                return trust, asset_tag
-        except:
+        if saml_data.lstrip()[:1] in (b'{', b'['):
             LOG.debug("System does not exist in the Mt. Wilson portal")
-
-        ns = {'saml2p': '{urn:oasis:names:tc:SAML:2.0:protocol}',
-              'saml2': '{urn:oasis:names:tc:SAML:2.0:assertion}'}
+            return trust, asset_tag
 
         try:
-            # xpath strings
-            xp_attributestatement = '{saml2}AttributeStatement/{saml2}Attribute'.format(**ns)
-            xp_attributevalue = '{saml2}AttributeValue'.format(**ns)
-
-            doc = etree.XML(saml_data)
-            elements = doc.findall(xp_attributestatement)
+            doc = etree.fromstring(saml_data, _SAML_PARSER)
 
-            for el in elements:
-                if el.attrib['Name'].lower() == 'trusted':
-                    if el.find(xp_attributevalue).text == 'true':
+            for el in _XP_ATTRIBUTES(doc):
+                name = el.attrib['Name'].lower()
+                if name == 'trusted':
+                    values = _XP_ATTRIBUTE_VALUE(el)
+                    if values and values[0] == 'true':
                         trust = True
-                elif el.attrib['Name'].lower().startswith("tag"):
-                    asset_tag[el.attrib['Name'].lower().split('[')[1].split(']')[0].lower()] = el.find(
-                        xp_attributevalue).text.lower()
+                elif name.startswith("tag"):
+                    tag = name.split('[')[1].split(']')[0]
+                    asset_tag[tag] = _XP_ATTRIBUTE_VALUE(el)[0].lower()
 
             return trust, asset_tag
-        except:
-            return trust, asset_tag
+        except (etree.XMLSyntaxError, ValueError, KeyError, IndexError,
+                AttributeError):
+            LOG.debug("Invalid attestation report")
+            return False, {}
 
     # Verifies the asset tag match with the tag selections provided by the user.
-    def verify_asset_tag(self, host_tags, tag_selections):
+    def verify_asset_tag(self, host_tags, sel_tags):
         # host_tags is the list of tags set on the host
-        # tag_selections is the list of tags set as the policy of the image
-        ret_status = False
-        selection_details = {}
-
-        try:
-            sel_tags = ast.literal_eval(tag_selections.lower())
-
-            iteration_status = True
-            for tag in list(sel_tags.keys()):
-                if tag not in list(host_tags.keys()) or host_tags[tag] not in sel_tags[tag]:
-                    # if tag not in dict((k.lower(),v) for k,v in host_tags.items()).keys() or host_tags[tag.lower()].lower() not in (val.upper() for val in sel_tags[tag]:
-                    iteration_status = False
-            if (iteration_status):
-                ret_status = True
-        except:
-            ret_status = False
+        # sel_tags is the parsed list of tags set as the policy of the image
+        if sel_tags is None:
+            return False
 
-        return ret_status
+        for tag, allowed in sel_tags.items():
+            if tag not in host_tags or host_tags[tag] not in allowed:
+                return False
+        return True
 
     def is_trusted(self, hostname, tags= None):
         try:
             # to be called from instance manager on instance strat
-            service = AttestationService()
-            host_data = service.do_attestation(hostname)
+            # Always attest the host again, this check must not rely on
+            # the scheduling cache
+            host_data = self.attestservice.do_attestation(hostname)
             trust, asset_tag = self.verify_and_parse_saml(host_data)
             if not trust:
                 return False
             if tags is not None and tags != 'None' and tags!={}:
-                return self.verify_asset_tag(asset_tag, tags)
+                return self.verify_asset_tag(
+                    asset_tag, self._parse_tag_selections(tags))
             return True
-        except:
+        except Exception:
+            LOG.exception(_LE("Unable to verify the trust of host %s"),
+                          hostname)
             return False
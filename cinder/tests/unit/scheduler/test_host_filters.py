@@ -25,6 +25,7 @@ from cinder import context
 from cinder import db
 from cinder import exception
 from cinder.scheduler import filters
+from cinder.scheduler.filters import asset_tag_filter
 from cinder.scheduler.filters import extra_specs_ops
 from cinder import test
 from cinder.tests.unit import fake_constants as fake
@@ -1080,6 +1081,242 @@ class InstanceLocalityFilterTestCase(BackendFiltersTestCase):
                           filt_cls.backend_passes, host, filter_properties)
 
 
+def _fake_saml(trusted, tags=None):
+    attributes = ('<saml2:Attribute Name="Trusted"><saml2:AttributeValue>'
+                  '%s</saml2:AttributeValue></saml2:Attribute>' %
+                  ('true' if trusted else 'false'))
+    for name, value in (tags or {}).items():
+        attributes += ('<saml2:Attribute Name="TAG[%s]"><saml2:AttributeValue>'
+                       '%s</saml2:AttributeValue></saml2:Attribute>' %
+                       (name, value))
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<saml2:Assertion '
+            'xmlns:saml2="urn:oasis:names:tc:SAML:2.0:assertion">'
+            '<saml2:AttributeStatement>%s</saml2:AttributeStatement>'
+            '</saml2:Assertion>' % attributes).encode('utf-8')
+
+
+@ddt.ddt
+class TrustAssertionFilterTestCase(BackendFiltersTestCase):
+    def setUp(self):
+        super(TrustAssertionFilterTestCase, self).setUp()
+        # The attestation cache and service are shared module globals
+        self.mock_object(asset_tag_filter, '_attestation_cache', {})
+        self.mock_object(asset_tag_filter, '_ATTESTATION_SERVICE', None)
+        self.override_config('attestation_auth_timeout', 60,
+                             'trusted_computing')
+        self.mock_attest = self.mock_object(
+            asset_tag_filter.AttestationService, 'do_attestation',
+            return_value=_fake_saml(True))
+        self.mock_time = self.mock_object(asset_tag_filter, 'time').time
+        self.mock_time.return_value = 1000
+        self.filt_cls = self.class_map['TrustAssertionFilter']()
+
+    def _filter_properties(self, metadata):
+        return {'metadata': metadata,
+                'request_spec': {'image_id': fake.IMAGE_ID,
+                                 'snapshot_id': None}}
+
+    def _filter(self, hosts, metadata=None):
+        backends = [fakes.FakeBackendState(host, {}) for host in hosts]
+        metadata = {'trust': 'trusted'} if metadata is None else metadata
+        return [backend.host for backend in self.filt_cls.filter_all(
+            backends, self._filter_properties(metadata))]
+
+    def test_backends_on_same_host_attested_once(self):
+        self.assertEqual(['hostX@a', 'hostX@b'],
+                         self._filter(['hostX@a', 'hostX@b']))
+        self.mock_attest.assert_called_once_with('hostX')
+
+    @mock.patch.object(asset_tag_filter, 'AttestationService')
+    def test_no_trust_passes_without_attestation(self, mock_service):
+        self.assertEqual(['host1', 'host2'],
+                         self._filter(['host1', 'host2'], {'key': 'value'}))
+        mock_service.assert_not_called()
+
+    def test_blank_volume_requires_trust(self):
+        self.mock_attest.return_value = _fake_saml(False)
+        backends = [fakes.FakeBackendState('host1', {})]
+        filter_properties = {'metadata': {},
+                             'request_spec': {'image_id': None,
+                                              'snapshot_id': None}}
+        self.assertEqual([], list(self.filt_cls.filter_all(
+            backends, filter_properties)))
+        self.mock_attest.assert_called_once_with('host1')
+
+    def test_untrusted_host_filtered(self):
+        self.mock_attest.side_effect = lambda host: _fake_saml(
+            host == 'host1')
+        self.assertEqual(['host1'], self._filter(['host1', 'host2']))
+
+    def test_trusted_cache_hit_before_timeout(self):
+        self._filter(['host1'])
+        self.mock_time.return_value = 1059
+        self.assertEqual(['host1'], self._filter(['host1']))
+        self.assertEqual(1, self.mock_attest.call_count)
+
+    def test_trusted_cache_requeried_after_timeout(self):
+        self._filter(['host1'])
+        self.mock_time.return_value = 1060
+        self.assertEqual(['host1'], self._filter(['host1']))
+        self.assertEqual(2, self.mock_attest.call_count)
+
+    def test_is_trusted_ignores_cache(self):
+        self._filter(['host1'])
+        self.mock_attest.return_value = _fake_saml(False)
+        self.assertFalse(self.filt_cls.is_trusted('host1'))
+        self.assertEqual(2, self.mock_attest.call_count)
+
+    @ddt.data((_fake_saml(True, {'Country': 'US'}), (True, {'country': 'us'})),
+              (_fake_saml(False), (False, {})))
+    @ddt.unpack
+    def test_verify_and_parse_saml(self, saml_data, expected):
+        self.assertEqual(expected,
+                         self.filt_cls.verify_and_parse_saml(saml_data))
+
+    @ddt.data(("{'country': ['us', 'uk']}", True),
+              ("{'country': ('us', 'uk')}", True),
+              ("{'country': ['us',],}", True),
+              ("{'country': ['fr']}", False),
+              ("{'region': ['eu']}", False),
+              ("not a dictionary", False))
+    @ddt.unpack
+    def test_asset_tag_selections(self, tag_selections, passes):
+        self.mock_attest.return_value = _fake_saml(True, {'Country': 'US'})
+        metadata = {'trust': 'trusted', 'asset_tags': tag_selections}
+        self.assertEqual(['host1'] if passes else [],
+                         self._filter(['host1'], metadata))
+
+    @ddt.data(("{'country': 'us'}", True),
+              ("{'country': 'usa'}", False))
+    @ddt.unpack
+    def test_single_asset_tag_value_matches_exactly(self, tag_selections,
+                                                    passes):
+        self.mock_attest.return_value = _fake_saml(True, {'Country': 'US'})
+        metadata = {'trust': 'trusted', 'asset_tags': tag_selections}
+        self.assertEqual(['host1'] if passes else [],
+                         self._filter(['host1'], metadata))
+
+    @ddt.data(b'{"error": "Host not found"}', b'<saml2:Assertion', b'', None)
+    def test_verify_and_parse_saml_invalid_report(self, saml_data):
+        self.assertEqual((False, {}),
+                         self.filt_cls.verify_and_parse_saml(saml_data))
+
+    def test_untrusted_cache_expires_at_quarter_timeout(self):
+        self.mock_attest.return_value = _fake_saml(False)
+        self._filter(['host1'])
+        self.mock_time.return_value = 1014
+        self.assertEqual([], self._filter(['host1']))
+        self.assertEqual(1, self.mock_attest.call_count)
+
+        self.mock_attest.return_value = _fake_saml(True)
+        self.mock_time.return_value = 1015
+        self.assertEqual(['host1'], self._filter(['host1']))
+        self.assertEqual(2, self.mock_attest.call_count)
+
+    def test_missing_report_not_cached(self):
+        self.mock_attest.return_value = None
+        self.assertEqual([], self._filter(['host1']))
+        self.assertEqual([], self._filter(['host1']))
+        self.assertEqual(2, self.mock_attest.call_count)
+        self.assertNotIn('host1', asset_tag_filter._attestation_cache)
+
+
+@ddt.ddt
+class AttestationServiceTestCase(test.TestCase):
+    def setUp(self):
+        super(AttestationServiceTestCase, self).setUp()
+        self.override_config('attestation_server', 'attester.example.com',
+                             'trusted_computing')
+        self.override_config('attestation_port', 8443, 'trusted_computing')
+        self.override_config('attestation_api_url', '/mtwilson/v2/assertions',
+                             'trusted_computing')
+        self.override_config('attestation_auth_blob', 'user:secret',
+                             'trusted_computing')
+
+    def _mock_request(self, service, status_code=200, content=b'report'):
+        return self.mock_object(service._session, 'request',
+                                return_value=mock.Mock(
+                                    status_code=status_code,
+                                    content=content))
+
+    def test_request_headers(self):
+        service = asset_tag_filter.AttestationService()
+        self.assertEqual({'x-auth-blob': 'user:secret',
+                          'Authorization': 'Basic dXNlcjpzZWNyZXQ=',
+                          'Accept': asset_tag_filter.SAML_ASSERTION_FORMAT},
+                         service._headers)
+        mock_request = self._mock_request(service)
+
+        service._request('GET', '?nameEqualTo=host1', 'host1')
+        self.assertIs(service._headers,
+                      mock_request.call_args[1]['headers'])
+
+    def test_request_headers_other_format(self):
+        service = asset_tag_filter.AttestationService()
+        mock_request = self._mock_request(service)
+
+        service._request('GET', '?nameEqualTo=host1', 'host1',
+                         resp_format='application/json')
+        headers = mock_request.call_args[1]['headers']
+        self.assertEqual('application/json', headers['Accept'])
+        self.assertEqual('Basic dXNlcjpzZWNyZXQ=', headers['Authorization'])
+        self.assertEqual(asset_tag_filter.SAML_ASSERTION_FORMAT,
+                         service._headers['Accept'])
+
+    def test_verify_insecure_ssl(self):
+        self.override_config('attestation_insecure_ssl', True,
+                             'trusted_computing')
+        self.override_config('attestation_server_ca_file', '/etc/ca.pem',
+                             'trusted_computing')
+        service = asset_tag_filter.AttestationService()
+        self.assertIs(False, service.verify)
+        self.assertIs(False, service._session.verify)
+
+    def test_verify_ca_file(self):
+        self.override_config('attestation_server_ca_file', '/etc/ca.pem',
+                             'trusted_computing')
+        service = asset_tag_filter.AttestationService()
+        self.assertEqual('/etc/ca.pem', service.verify)
+        self.assertEqual('/etc/ca.pem', service._session.verify)
+
+    def test_verify_system_cas(self):
+        service = asset_tag_filter.AttestationService()
+        self.assertIs(True, service.verify)
+        self.assertIs(True, service._session.verify)
+
+    def test_do_request_failure(self):
+        service = asset_tag_filter.AttestationService()
+        self.mock_object(service._session, 'request',
+                         side_effect=request_exceptions.ConnectionError)
+        self.assertEqual((IOError, None),
+                         service._do_request('GET', '', 'host1', {}))
+
+    @ddt.data(200, 201, 202, 204)
+    def test_do_request_success(self, status_code):
+        service = asset_tag_filter.AttestationService()
+        self._mock_request(service, status_code)
+        self.assertEqual((200, b'report'),
+                         service._do_request('GET', '', 'host1', {}))
+
+    @ddt.data(401, 404, 500)
+    def test_do_request_error_status(self, status_code):
+        service = asset_tag_filter.AttestationService()
+        self._mock_request(service, status_code)
+        self.assertEqual((status_code, None),
+                         service._do_request('GET', '', 'host1', {}))
+
+    def test_do_attestation_url(self):
+        service = asset_tag_filter.AttestationService()
+        mock_request = self._mock_request(service)
+
+        self.assertEqual(b'report', service.do_attestation('host 1&x'))
+        mock_request.assert_called_once_with(
+            'GET', 'https://attester.example.com:8443'
+            '/mtwilson/v2/assertions?nameEqualTo=host+1%26x',
+            data='"host 1&x"', headers=service._headers)
+
+
 class TestFilter(filters.BaseBackendFilter):
     pass
 